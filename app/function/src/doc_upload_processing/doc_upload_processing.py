@@ -16,28 +16,50 @@
 import logging
 import sys
 import os
-import tempfile
+import re
 import json
+from io import BytesIO
 from zipfile import ZipFile
-from base64 import b16decode
+from binascii import unhexlify
 
 import boto3
 import botocore.client
 from botocore.client import Config
+from boto3.s3.transfer import TransferConfig, create_transfer_manager
+from s3transfer.subscribers import BaseSubscriber
 
 logging.basicConfig(stream=sys.stdout)
 logger = logging.getLogger('myLambda')
 LOG_LEVEL = str(os.environ["LOG_LEVEL"]).upper()
 logger.setLevel(LOG_LEVEL)
+# The log level is fixed for the lifetime of the Lambda environment
+DEBUG_ENABLED = logger.isEnabledFor(logging.DEBUG)
 
 STORE_BUCKET_NAME = os.environ["STORE_BUCKET_NAME"]
 REQ_KW = os.environ["TOPIC_REQ_KW"]
 ACK_KW = os.environ["TOPIC_ACK_KW"]
+# Metadata keys that must be present on an uploaded archive
+EXPECTED_MDATA_KEYS = frozenset({'org-mqtt-topic', 'requestUuid'})
+# Number of documents uploaded to S3 concurrently
+UPLOAD_WORKERS = 16
+# Archive member names that are absolute or contain a '..' component
+UNSAFE_MEMBER_RE = re.compile(r'(^/|(^|/)\.\.(/|$))')
 
+# Connections are kept alive and reused across warm invocations
+client_config = Config(max_pool_connections=32,
+                       tcp_keepalive=True,
+                       retries={'mode': 'adaptive', 'max_attempts': 5}
+                       )
 s3_client = boto3.client('s3',
-                         config=Config(signature_version='s3v4')
+                         config=client_config.merge(Config(signature_version='s3v4'))
                          )
-iot_client = boto3.client('iot-data')
+iot_client = boto3.client('iot-data', config=client_config)
+# Compact JSON encoder shared by all the publish calls
+json_encoder = json.JSONEncoder(separators=(',', ':'))
+# The transfer manager and its threads are reused across warm invocations
+transfer_manager = create_transfer_manager(s3_client,
+                                           TransferConfig(max_concurrency=UPLOAD_WORKERS, use_threads=True)
+                                           )
 
 
 class InvalidMetadata(Exception):
@@ -50,7 +72,7 @@ def b16low2s(s):
     :param s: Base16 encoded string
     :return: decoded string
     """
-    return b16decode(s, casefold=True).decode('utf-8')
+    return unhexlify(s).decode('utf-8')
 
 
 def decode_metadata(metadata):
@@ -59,10 +81,7 @@ def decode_metadata(metadata):
     :param metadata: a dict of Base16 encoded keys and values
     :return: A dict with keys and values decoded as strings
     """
-    decoded_metadata = {}
-    for k, v in metadata.items():
-        decoded_metadata[b16low2s(k)] = b16low2s(v)
-    return decoded_metadata
+    return {b16low2s(k): b16low2s(v) for k, v in metadata.items()}
 
 
 def check_metadata(mdata):
@@ -71,38 +90,106 @@ def check_metadata(mdata):
     :param mdata: a dict containing the metadata
     :return: True if the metadata is valid, False otherwise
     """
-    expected_keys = {'org-mqtt-topic', 'requestUuid'}
-    payload_keys = set(mdata.keys())
-    is_ok = expected_keys.issubset(payload_keys)
+    is_ok = EXPECTED_MDATA_KEYS.issubset(mdata.keys())
     if is_ok is not True:
         logger.error("The received payload keys: {} does not contain the expected keys: {}"
-                     .format(payload_keys, expected_keys))
+                     .format(set(mdata.keys()), EXPECTED_MDATA_KEYS))
 
     return is_ok
 
 
-def process_dir(extract_path, cu_path, partition_path):
+def is_safe_member(name):
     """
-    Recursively process a directory and store documents to S3 with a partitioning corresponding to the path below
-    the extract_path.
-    :param extract_path: The path where the recursive discovery starts
-    :param cu_path: the path below the extract_path
-    :param partition_path: current the S3 partition path
+    Check that an archive member stays below the partition once used as an S3 key.
+    :param name: the name of the member in the archive
+    :return: True if the name is neither absolute nor contains a '..' component, False otherwise
+    """
+    return UNSAFE_MEMBER_RE.search(name) is None
+
+
+class ArchiveMember(BaseSubscriber):
+    """
+    Tie an opened archive member to its upload. The uncompressed size is provided to the transfer manager, which
+    would otherwise find it by seeking to the end of the member, decompressing it twice. The member is closed once
+    its upload is done, so its decompressor is not kept for the rest of the archive.
+    """
+    def __init__(self, src, size):
+        self.src = src
+        self.size = size
+
+    def on_queued(self, future, **kwargs):
+        future.meta.provide_transfer_size(self.size)
+
+    def on_done(self, future, **kwargs):
+        self.src.close()
+
+
+def upload_member(zf, info, partition_path):
+    """
+    Stream a single archive member to S3, without writing it to disk.
+    :param zf: the opened ZipFile
+    :param info: the ZipInfo of the member
+    :param partition_path: the S3 partition path
+    :return: the transfer future of the upload, the member is closed when it is done
+    """
+    dest_key = f"{partition_path}/{info.filename}"
+    logger.debug("Moving archive member %s to S3 %s:%s", info.filename, STORE_BUCKET_NAME, dest_key)
+    src = zf.open(info)
+    try:
+        return transfer_manager.upload(src, STORE_BUCKET_NAME, dest_key,
+                                       subscribers=[ArchiveMember(src, info.file_size)])
+    except Exception:
+        src.close()
+        raise
+
+
+def wait_uploads(futures, errors):
+    """
+    Wait for uploads to be done, collecting their errors instead of raising them.
+    :param futures: the transfer futures to wait for
+    :param errors: the list the errors are appended to
     :return: None
     """
-    abs_cu_path = str(os.path.join(extract_path, cu_path))
-    extracted = os.listdir(abs_cu_path)
-    logger.debug("List of extracted docs: {}".format(extracted))
-    for doc in extracted:
-        logger.debug("Processing: {}".format(doc))
-        doc_path = os.path.join(abs_cu_path, doc)
-        if os.path.isfile(doc_path):
-            dest_key = "{}/{}".format(partition_path, os.path.join(cu_path, doc))
-            logger.debug(
-                "Moving extracted file {} to S3 {}:{}".format(doc_path, STORE_BUCKET_NAME, dest_key))
-            s3_client.upload_file(doc_path, STORE_BUCKET_NAME, dest_key)
-        elif os.path.isdir(doc_path):
-            process_dir(extract_path, str(os.path.join(cu_path, doc)), partition_path)
+    for future in futures:
+        try:
+            future.result()
+        except Exception as e:
+            errors.append(e)
+
+
+def process_archive(zf, partition_path):
+    """
+    Store the documents of an archive to S3 with a partitioning corresponding to their path in the archive.
+    The uploads run concurrently in the transfer manager as they are dominated by the round-trip to S3.
+    :param zf: the opened ZipFile
+    :param partition_path: the S3 partition path
+    :return: None
+    """
+    members = []
+    for info in zf.infolist():
+        if info.is_dir():
+            continue
+        if not is_safe_member(info.filename):
+            logger.warning("Skipping archive member with an unsafe path: {}".format(info.filename))
+            continue
+        members.append(info)
+    if DEBUG_ENABLED:
+        logger.debug("List of archived docs: %s", [info.filename for info in members])
+    futures = []
+    errors = []
+    try:
+        for info in members:
+            # Members are opened lazily, no more than the uploads in flight are kept open
+            if len(futures) >= UPLOAD_WORKERS:
+                wait_uploads([futures.pop(0)], errors)
+            if errors:
+                break
+            futures.append(upload_member(zf, info, partition_path))
+    finally:
+        # Every submitted upload is awaited, even when opening a member failed, before the archive is closed
+        wait_uploads(futures, errors)
+    if errors:
+        raise errors[0]
 
 
 def lambda_handler(event, context):
@@ -111,37 +198,39 @@ def lambda_handler(event, context):
     The new object is expected to have been uploaded by an IoT Device, to contain Base16 encoded metadata and to be a
     ZIP archive. This archive will be unzipped to a destination Bucket and the original archive deleted.
     """
-    logger.debug("Lambda processing called with: {}".format(event))
-    mdata = {}
+    logger.debug("Lambda processing called with: %s", event)
     for record in event['Records']:
+        mdata = {}
+        # The GET response, its streaming body is closed whatever the outcome
+        s3_object = None
+        # Both the success and the failure ACK are published on this topic, once known
+        response_topic = None
         source_bucket = record['s3']['bucket']['name']
         object_key = record['s3']['object']['key']
-        logger.debug("Processing uploaded object: {}".format(object_key))
+        logger.debug("Processing uploaded object: %s", object_key)
         try:
             try:
-                mdata_encoded = s3_client.head_object(Bucket=source_bucket, Key=object_key)['Metadata']
-                logger.debug("Encoded metadata: {}".format(mdata_encoded))
+                # A single GET returns both the metadata and the archive
+                logger.debug("Getting object: %s", object_key)
+                s3_object = s3_client.get_object(Bucket=source_bucket, Key=object_key)
+                mdata_encoded = s3_object['Metadata']
+                logger.debug("Encoded metadata: %s", mdata_encoded)
                 mdata = decode_metadata(mdata_encoded)
-                logger.debug("Retrieved metadata: {}".format(mdata))
+                logger.debug("Retrieved metadata: %s", mdata)
+                if 'org-mqtt-topic' in mdata:
+                    response_topic = mdata['org-mqtt-topic'].replace(REQ_KW, ACK_KW)
             except botocore.client.ClientError as e:
                 raise InvalidMetadata(e)
             if check_metadata(mdata) is not True:
                 raise InvalidMetadata("Missing metadata key(s)")
             # The partition where the archive will be extracted is equal to the MQTT topic
             partition_path = mdata['org-mqtt-topic']
-            # Extract the archive and upload each document to S3
-            with tempfile.TemporaryDirectory() as d:
-                with open("{}/{}".format(d, object_key), mode='wb') as f:
-                    logger.debug("Getting object: {}".format(object_key))
-                    s3_client.download_fileobj(source_bucket, object_key, f)
-                with ZipFile("{}/{}".format(d, object_key), 'r') as zf:
-                    logger.debug("Extracting archive object: {}".format(object_key))
-                    extract_path = os.path.join(d, 'content')
-                    zf.extractall(extract_path)
-
-                process_dir(extract_path, "", partition_path)
-
-            response_topic = mdata['org-mqtt-topic'].replace(REQ_KW, ACK_KW)
+            # The archive is kept in memory and its documents are streamed to S3 without touching the disk
+            archive = BytesIO(s3_object['Body'].read())
+            with ZipFile(archive, 'r') as zf:
+                logger.debug("Extracting archive object: %s", object_key)
+                process_archive(zf, partition_path)
+
             payload = {
                 'success': True,
                 'requestUuid': mdata['requestUuid']
@@ -150,16 +239,15 @@ def lambda_handler(event, context):
             result = iot_client.publish(
                 topic=response_topic,
                 qos=1,
-                payload=json.dumps(payload)
+                payload=json_encoder.encode(payload)
             )
-            logger.debug("Publish result: {}".format(result))
+            logger.debug("Publish result: %s", result)
             logger.info("Deleting source file from S3: {}:{}".format(source_bucket, object_key))
             s3_client.delete_object(Bucket=source_bucket, Key=object_key)
 
         except Exception as e:
             logger.error("Error when processing Uploaded file: {}".format(e))
-            if 'org-mqtt-topic' in mdata:
-                response_topic = mdata['org-mqtt-topic'].replace(REQ_KW, ACK_KW)
+            if response_topic is not None:
                 payload = {
                     'success': False,
                     'requestUuid': mdata.get('requestUuid', 'NotFound')
@@ -168,10 +256,13 @@ def lambda_handler(event, context):
                 result = iot_client.publish(
                     topic=response_topic,
                     qos=1,
-                    payload=json.dumps(payload)
+                    payload=json_encoder.encode(payload)
                 )
-                logger.debug("Publish result: {}".format(result))
+                logger.debug("Publish result: %s", result)
             else:
                 logger.error("Could not send ACK to uploader because metadata key 'org-mqtt-topic' is missing.")
             logger.warning("The object has not been deleted: {}.{}".format(source_bucket, object_key))
             raise
+        finally:
+            if s3_object is not None:
+                s3_object['Body'].close()
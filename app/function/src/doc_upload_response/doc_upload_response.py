@@ -18,9 +18,7 @@ import sys
 import os
 import time
 import json
-from base64 import b64encode, b16encode
-from binascii import unhexlify
-from uuid import uuid4
+from binascii import b2a_base64, hexlify, unhexlify
 
 import boto3
 from botocore.exceptions import ClientError
@@ -35,13 +33,23 @@ STG_BUCKET = os.environ["STG_BUCKET_NAME"]
 REQ_KW = os.environ["TOPIC_REQ_KW"]
 RESP_KW = os.environ["TOPIC_RESP_KW"]
 
+# Keys that must be present in the request payload
+EXPECTED_PAYLOAD_KEYS = frozenset({'topic', 'requestUuid', 'sha256'})
+
 # The content type of teh Upload is fixed to ZIP but can be easily made variable
 CONTENT_TYPE = "application/zip"
 
+# Connections are kept alive and reused across warm invocations
+client_config = Config(max_pool_connections=32,
+                       tcp_keepalive=True,
+                       retries={'mode': 'adaptive', 'max_attempts': 5}
+                       )
 s3_client = boto3.client('s3',
-                         config=Config(signature_version='s3v4')
+                         config=client_config.merge(Config(signature_version='s3v4'))
                          )
-iot_client = boto3.client('iot-data')
+iot_client = boto3.client('iot-data', config=client_config)
+# Compact JSON encoder shared by all the publish calls
+json_encoder = json.JSONEncoder(separators=(',', ':'))
 
 
 class PayloadException(Exception):
@@ -54,25 +62,22 @@ def is_payload_ok(payload):
     :param payload: the erceived payload
     :return: True if OK or False
     """
-    expected_keys = {'topic', 'requestUuid', 'md5'}
-    payload_keys = set(payload.keys())
-    diff = expected_keys.difference(payload_keys)
-    if diff:
+    if not EXPECTED_PAYLOAD_KEYS.issubset(payload.keys()):
         logger.error("The received payload keys: {} does not contain the expected keys: {}"
-                     .format(payload_keys, expected_keys))
+                     .format(set(payload.keys()), EXPECTED_PAYLOAD_KEYS))
         return False
     return True
 
 
-def md5_to_b64md5(md5):
+def sha256_to_b64sha256(sha256):
     """
-    Encodes with Base64 - this is requested by S3 MD5 field
-    :param md5: the standard md5 hash of the document to be uploaded to S3
-    :return: the Base64 encoded md5 as expected by S3
+    Encodes with Base64 - this is requested by S3 SHA-256 checksum field
+    :param sha256: the standard hex sha256 hash of the document to be uploaded to S3
+    :return: the Base64 encoded sha256 as expected by S3
     """
-    md5b64 = b64encode(unhexlify(md5)).decode()
-    logger.debug("Received md5: '{}' - returning B64 encoded: '{}'".format(md5, md5b64))
-    return md5b64
+    sha256b64 = b2a_base64(unhexlify(sha256), newline=False).decode('ascii')
+    logger.debug("Received sha256: '%s' - returning B64 encoded: '%s'", sha256, sha256b64)
+    return sha256b64
 
 
 def make_metadata(event_dict):
@@ -90,11 +95,11 @@ def make_metadata(event_dict):
 
 def s2b16low(s):
     """
-    Encodes with Base16 and forces resulting encoded string to lower case.
+    Encodes with Base16, hexlify already produces a lower case string.
     :param s: The string to be encoded
     :return: Base16 encoded string in lower case
     """
-    return b16encode(s.encode('utf-8')).decode('utf-8').lower()
+    return hexlify(s.encode('utf-8')).decode('ascii')
 
 
 def encode_metadata(metadata):
@@ -105,18 +110,15 @@ def encode_metadata(metadata):
     :param metadata: a dict containing the metadata in clear
     :return: dict of Base16 encoded metadata for keys and values
     """
-    encoded_metadata = {}
-    for k, v in metadata.items():
-        encoded_metadata[s2b16low(k)] = s2b16low(v)
-    return encoded_metadata
+    return {s2b16low(k): s2b16low(v) for k, v in metadata.items()}
 
 
-def get_presigned_url(metadata, content_type, md5, bucket=STG_BUCKET, key=None, expire=900):
+def get_presigned_url(metadata, content_type, sha256, bucket=STG_BUCKET, key=None, expire=900):
     """
     Get a presigned URL from S3
     :param metadata: the metadata dictionary
     :param content_type: content type at file upload time
-    :param md5: the md5 of the document to be uploaded
+    :param sha256: the sha256 of the document to be uploaded
     :param bucket: the bucket name where files need to be uploaded
     :param key: the key of the object in the bucket after upload
     :param expire: How long (seconds) this presigned UTL will be valid for (min: 900)
@@ -124,47 +126,47 @@ def get_presigned_url(metadata, content_type, md5, bucket=STG_BUCKET, key=None,
     """
     METHOD = "put_object"
     if not key:
-        key = str(uuid4())
+        key = os.urandom(16).hex()
 
-    md5e = md5_to_b64md5(md5)
+    sha256e = sha256_to_b64sha256(sha256)
 
     params = {
         'Bucket': bucket,
         'Key': key,
         'ContentType': content_type,
         'Metadata': metadata,
-        'ContentMD5': md5e,
+        'ChecksumSHA256': sha256e,
     }
 
     try:
-        exp_epoch = int((time.time() + expire) * 1000)
+        exp_epoch = time.time_ns() // 1_000_000 + expire * 1000
         response = s3_client.generate_presigned_url(ClientMethod=METHOD,
                                                     Params=params,
                                                     ExpiresIn=expire)
 
-        return {'md5e': md5e, 'exp': exp_epoch, 'url': response}
+        return {'sha256e': sha256e, 'exp': exp_epoch, 'url': response}
 
     except ClientError as e:
         logger.error("error when getting presigned URL: {}".format(e))
         raise
 
 
-def make_headers(metadata, content_type, md5_encoded):
+def make_headers(metadata, content_type, sha256_encoded):
     """
     Creates the headers required for S3 upload with the presigned URL. The sender will have to include those headers
     in the PUT request. This is necessary because a presigned URL signature also includes the Headers.
     :param metadata: the metadata dictionary
     :param content_type: the type of document to be uploaded
-    :param md5_encoded: the endcoded md5 of the payload to be uploaded
+    :param sha256_encoded: the endcoded sha256 of the payload to be uploaded
     :return: headers dictionary
     """
     headers = {
         'content-type': content_type,
-        'content-md5': md5_encoded,
+        'x-amz-checksum-sha256': sha256_encoded,
     }
     for k, v in metadata.items():
         headers['x-amz-meta-' + k] = v
-    logger.debug("Prepared headers: {}".format(headers))
+    logger.debug("Prepared headers: %s", headers)
     return headers
 
 
@@ -175,7 +177,7 @@ def lambda_handler(event, context):
     {
         'topic': <string>, # The MQTT topic where the request was received
         'requestUuid': <string>, # The original UUID passed by the sender in the request
-        'md5': <string>, # The md5 of the document to be uploaded
+        'sha256': <string>, # The hex sha256 of the document to be uploaded
     }
 
     The response will contain the following payload:
@@ -187,27 +189,27 @@ def lambda_handler(event, context):
     }
     """
     logger.info("Received a request to Upload a document: {}".format(event))
+    # Respond using the request topic swapping the request keyword for the response one
+    response_topic = event['topic'].replace(REQ_KW, RESP_KW)
     try:
         if is_payload_ok(event) is not True:
             logger.error("Payload not compliant, request ignored\n: {}".format(event))
             raise AttributeError("Non compliant payload")
         metadata = make_metadata(event)
         encoded_metadata = encode_metadata(metadata)
-        resp = get_presigned_url(metadata=encoded_metadata, content_type=CONTENT_TYPE, md5=event['md5'])
-        headers = make_headers(metadata=encoded_metadata, content_type=CONTENT_TYPE, md5_encoded=resp['md5e'])
-        # Respond using the request topic swapping the request keyword for the response one
-        response_topic = event['topic'].replace(REQ_KW, RESP_KW)
+        resp = get_presigned_url(metadata=encoded_metadata, content_type=CONTENT_TYPE, sha256=event['sha256'])
+        headers = make_headers(metadata=encoded_metadata, content_type=CONTENT_TYPE, sha256_encoded=resp['sha256e'])
         payload = {
             'requestUuid': event['requestUuid'],
             'url': resp['url'],
             'expiration': resp['exp'],
             'headers': headers
         }
-        logger.debug("Publishing on topic {} the payload {}".format(response_topic, payload))
+        logger.debug("Publishing on topic %s the payload %s", response_topic, payload)
         result = iot_client.publish(
             topic=response_topic,
             qos=1,
-            payload=json.dumps(payload)
+            payload=json_encoder.encode(payload)
         )
         logger.info("Published response to the request with result: {}".format(result))
     except Exception as e:
@@ -218,12 +220,11 @@ def lambda_handler(event, context):
             'expiration': 0,
             'headers': {}
         }
-        response_topic = event['topic'].replace(REQ_KW, RESP_KW)
-        logger.debug("Publishing on topic {} the payload {}".format(response_topic, payload))
+        logger.debug("Publishing on topic %s the payload %s", response_topic, payload)
         result = iot_client.publish(
             topic=response_topic,
             qos=1,
-            payload=json.dumps(payload)
+            payload=json_encoder.encode(payload)
         )
         logger.info("Published response to the request with result: {}".format(result))
         if not isinstance(e, PayloadException):
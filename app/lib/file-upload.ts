@@ -211,6 +211,9 @@ export class FileUpload extends Construct {
             code: lambda.Code.fromAsset("./function/src/doc_upload_processing"),
             runtime: lambda.Runtime.PYTHON_3_12,
             handler: "doc_upload_processing.lambda_handler",
+            // The archive is held in memory while up to 10 parts of 8 MiB per upload are buffered for S3
+            memorySize: 1024,
+            timeout: Duration.minutes(5),
             environmentEncryption: encryptionKey,
             logGroup: processingLambdaLogGroup
         });
@@ -248,6 +251,8 @@ export class FileUpload extends Construct {
                         `arn:aws:iot:${Stack.of(this).region}:${Stack.of(this).account}:topicfilter/${topicPrefix}/${topicResponseSuffix}/\${iot:Connection.Thing.ThingName}/*`,
                         `arn:aws:iot:${Stack.of(this).region}:${Stack.of(this).account}:topicfilter/${topicPrefix}/${topicAckSuffix}/\${iot:Connection.Thing.ThingName}`,
                         `arn:aws:iot:${Stack.of(this).region}:${Stack.of(this).account}:topicfilter/${topicPrefix}/${topicAckSuffix}/\${iot:Connection.Thing.ThingName}/*`,
+                        // Single filter covering both the response and ack topics, Receive still limits it to those
+                        `arn:aws:iot:${Stack.of(this).region}:${Stack.of(this).account}:topicfilter/${topicPrefix}/+/\${iot:Connection.Thing.ThingName}/#`,
                     ]
                 }, {
                     Effect: "Allow",
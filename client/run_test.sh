@@ -37,14 +37,14 @@ case $1 in
     --archive_path './test_data/bad_zip.zip'
     ;;
 
-  4) # Failure due to non-matching md5
+  4) # Failure due to non-matching sha256
     python test_client.py --endpoint $IOT_ENDPOINT \
     --cert  $CERT_PATH\
     --key  $KEY_PATH\
     --root_ca  $ROOT_CA_PATH\
     --client_id  $CLIENT_ID\
     --archive_path './test_data/archive.zip' \
-    --bad_md5
+    --bad_sha256
     ;;
 
   5) # Failure due to non-matching payload
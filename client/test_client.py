@@ -14,20 +14,47 @@
 # SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 import os.path
 
-from awscrt import mqtt
+from awscrt import io, mqtt
 from awsiot import mqtt_connection_builder
 import sys
 import threading
-import uuid
+import time
 import json
 import argparse
 import hashlib
-import requests
-from datetime import datetime, UTC
+import mmap
+import urllib3
+from concurrent.futures import ThreadPoolExecutor
+
+# orjson is faster and returns bytes directly, fall back to the standard library on constrained devices
+try:
+    import orjson
+    json_dumps = orjson.dumps
+    json_loads = orjson.loads
+except ImportError:
+    json_dumps = json.dumps
+    json_loads = json.loads
 
 # MQTT topics
 TOPIC_BASE = "awsSample/iotDocUpload"
 
+# Read size when streaming the archive to S3
+UPLOAD_BUFFER_SIZE = 1024 * 1024
+
+# A single event loop thread, host resolver and bootstrap, created once for the lifetime of the process
+event_loop_group = io.EventLoopGroup(1)
+host_resolver = io.DefaultHostResolver(event_loop_group)
+client_bootstrap = io.ClientBootstrap(event_loop_group, host_resolver)
+
+# Time allowed to receive both the response and the ACK, in seconds
+RECEIVE_TIMEOUT = 14
+# The S3 upload and its single retry on a transient error must fit in RECEIVE_TIMEOUT, the archive is unmapped after
+UPLOAD_TIMEOUT = urllib3.Timeout(connect=2.0, read=4.0)
+
+# HTTP connection pool for the S3 upload, the last response is returned rather than raised once retries are exhausted
+http = urllib3.PoolManager(retries=urllib3.Retry(total=1, backoff_factor=0.5, status_forcelist=(500, 502, 503, 504),
+                                                 raise_on_status=False))
+
 
 # Callback when the connection successfully connects
 def on_connection_success(connection, callback_data):
@@ -99,103 +126,197 @@ def initialise(args, receiver_class):
         on_connection_success=on_connection_success,
         on_connection_failure=on_connection_failure,
         on_connection_closed=on_connection_closed,
+        client_bootstrap=client_bootstrap,
     )
     print("Connecting to endpoint with client ID {}".format(args.client_id))
     connect_future = mqtt_connection.connect()
     connect_future.result()
     print("Connected!")
 
-    # Subscribe to response topic
-    response_topic = "{}/{}/{}/#".format(TOPIC_BASE, "docUpldResp", args.client_id)
-    print("Subscribing to topic '{}'...".format(response_topic))
+    # A single subscription covers both the response and ack topics, the messages are routed by the receiver
+    upload_topic = "{}/+/{}/#".format(TOPIC_BASE, args.client_id)
+    print("Subscribing to topic '{}'...".format(upload_topic))
     subscribe_future, packet_id = mqtt_connection.subscribe(
-        topic=response_topic,
+        topic=upload_topic,
         qos=mqtt.QoS.AT_LEAST_ONCE,
-        callback=receiver_class.on_response_received)
+        callback=receiver_class.on_message_received)
 
     subscribe_result = subscribe_future.result()
     print("Subscribed with {}".format(str(subscribe_result['qos'])))
 
-    ack_topic = "{}/{}/{}/#".format(TOPIC_BASE, "docUpldAck", args.client_id)
-    print("Subscribing to topic '{}'...".format(ack_topic))
-    subscribe_future, packet_id = mqtt_connection.subscribe(
-        topic=ack_topic,
-        qos=mqtt.QoS.AT_LEAST_ONCE,
-        callback=receiver_class.on_ack_received)
+    return mqtt_connection
 
-    subscribe_result = subscribe_future.result()
-    print("Subscribed with {}".format(str(subscribe_result['qos'])))
 
-    return mqtt_connection
+def open_archive(path):
+    """
+    Open the archive once and memory-map it, the mapping stays valid after the file is closed
+    :param path: the path of the archive
+    :return: a read-only mmap of the archive, to be closed by the caller
+    """
+    with open(path, 'rb') as f:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
 
+def compute_sha256(archive):
+    """
+    Compute the sha256 of a memory-mapped file, hashlib hashes the mapping directly and releases the GIL
+    :param archive: the mmap of the file
+    :return: the sha256 hex digest
+    """
+    return hashlib.sha256(archive).hexdigest()
 
-def make_request(args, connection):
+
+def cached_sha256(path, archive):
+    """
+    Get the sha256 of a file, reusing the value stored in a '<path>.sha256' sidecar file when the file size and
+    modification time have not changed since it was computed.
+    :param path: the path of the file
+    :param archive: the mmap of the file, hashed on a cache miss
+    :return: the sha256 hex digest
+    """
+    st = os.stat(path)
+    cache_path = path + '.sha256'
+    try:
+        with open(cache_path) as f:
+            cache = json.load(f)
+        if cache['size'] == st.st_size and cache['mtime_ns'] == st.st_mtime_ns:
+            return cache['sha256']
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+
+    sha256 = compute_sha256(archive)
+    # Write then rename so a concurrent run never reads a partial cache
+    tmp_path = "{}.{}.tmp".format(cache_path, os.getpid())
+    try:
+        with open(tmp_path, 'w') as f:
+            json.dump({'size': st.st_size, 'mtime_ns': st.st_mtime_ns, 'sha256': sha256}, f)
+        os.replace(tmp_path, cache_path)
+    except OSError as e:
+        print("Could not cache the sha256 of {}: {}".format(path, e))
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+    return sha256
+
+
+def make_request(args, connection, sha256_future, receiver):
     """
     Make a request to upload a new archive
     :param connection: The MQTT connection
     :param args: command line arguments
+    :param sha256_future: a future of the archive sha256 being computed, None when testing a bad hash
+    :param receiver: the ReceiveCallbacks expecting the response and ack of this request
     :return: nothing
     """""
-    if not os.path.isfile(args.archive_path):
-        print("File {} does not exist".format(args.archive_path))
-        return
-    if args.bad_md5 is not True:
-        md5 = hashlib.new(
-            name='md5',
-            data=open(args.archive_path, 'rb').read(),
-            usedforsecurity=False).hexdigest()
+    if args.bad_sha256 is True:
+        sha256 = "1" * 64
     else:
-        md5 = "11111111111111111111111111111111"
+        sha256 = sha256_future.result()
     payload = {
-        'requestUuid': str(uuid.uuid4()),
-        'md5': md5
+        # Only a correlator, unique for this client: no need to draw a random UUID
+        'requestUuid': "{}-{}".format(args.client_id, time.time_ns()),
+        'sha256': sha256
     }
     if args.bad_payload is True:
-        payload.pop('md5')
+        payload.pop('sha256')
     topic = "{}/{}/{}/{}".format(
         TOPIC_BASE,
         "docUpldReq",
         args.client_id,
-        datetime.now(UTC).strftime("%Y-%m-%dT%H:%M:%SZ"))
+        time.time_ns())
+    # The response and ack topics end with the same segment as the request topic
+    receiver.expected_topic_suffix = topic[topic.rindex('/'):]
     print("Publishing message to topic '{}': {}".format(topic, payload))
+    # No PUBACK is needed: the response and ack messages already confirm the request end-to-end
     publish_future, packet_id = connection.publish(
         topic=topic,
-        payload=json.dumps(payload),
-        qos=mqtt.QoS.AT_LEAST_ONCE)
+        payload=json_dumps(payload),
+        qos=mqtt.QoS.AT_MOST_ONCE)
     publish_result = publish_future.result()
     print("Published to topic {} with result: {}".format(topic, publish_result))
 
 
+class ArchiveBody(object):
+    """
+    PUT body streaming the memory-mapped archive in large slices, so the socket is fed with MB-sized writes instead
+    of the small blocks used for file objects. It can be iterated again if the upload is retried.
+    """
+    def __init__(self, archive, chunk_size=UPLOAD_BUFFER_SIZE):
+        self.archive = archive
+        self.chunk_size = chunk_size
+
+    def __len__(self):
+        return len(self.archive)
+
+    def __iter__(self):
+        for offset in range(0, len(self.archive), self.chunk_size):
+            yield self.archive[offset:offset + self.chunk_size]
+
+
 class ReceiveCallbacks(object):
-    def __init__(self, args, timeout=7):
+    def __init__(self, args, archive, timeout=RECEIVE_TIMEOUT):
         self.args = args
-        # Events tracking
-        self.received_response = threading.Event()
-        self.received_ack = threading.Event()
+        # Last segment of the request topic, messages on other topics are ignored without being parsed
+        self.expected_topic_suffix = None
+        # The memory-mapped archive, shared with the hashing so the file is only opened once
+        self.archive = archive
+        # Events tracking: messages still expected, the waiter is notified as each one arrives
+        self.pending = {'response', 'ack'}
+        self.received = threading.Condition()
         self.timeout = timeout
         self.success = False
 
+    def is_expected_topic(self, topic):
+        if self.expected_topic_suffix is None or not topic.endswith(self.expected_topic_suffix):
+            print("Ignoring message from unexpected topic '{}'".format(topic))
+            return False
+        return True
+
+    def on_message_received(self, topic, payload, dup, qos, retain, **kwargs):
+        # The topic keyword follows the base: TOPIC_BASE/<keyword>/<client_id>/...
+        keyword = topic[len(TOPIC_BASE) + 1:].split('/', 1)[0]
+        if keyword == "docUpldResp":
+            self.on_response_received(topic, payload, dup, qos, retain, **kwargs)
+        elif keyword == "docUpldAck":
+            self.on_ack_received(topic, payload, dup, qos, retain, **kwargs)
+        else:
+            print("Ignoring message from unexpected topic '{}'".format(topic))
+
     def on_response_received(self, topic, payload, dup, qos, retain, **kwargs):
+        if not self.is_expected_topic(topic):
+            return
         print("Received RESPONSE message from topic '{}': {}".format(topic, payload))
-        data = json.loads(payload)
+        data = json_loads(payload)
         ruuid = data.get('requestUuid')
         url = data.get('url')
         exp = data.get('expiration')
         headers = data.get('headers')
-        if not url:
-            print("Upload request was rejected. The document will not be uploaded to S3.")
-        else:
-            print("Uploading document {} to S3".format(self.args.archive_path))
-            result = requests.put(
-                url=url,
-                data=open(self.args.archive_path, 'rb'),
-                headers=headers,
-                timeout=3)
-            print("Upload to S3 result: code={}, content={}".format(result, result.content))
-        self.received_response.set()
+        try:
+            if not url:
+                print("Upload request was rejected. The document will not be uploaded to S3.")
+            else:
+                print("Uploading document {} to S3".format(self.args.archive_path))
+                body = ArchiveBody(self.archive)
+                # A known length avoids a chunked transfer, which S3 does not accept for a presigned PUT
+                headers['content-length'] = str(len(body))
+                result = http.request(
+                    'PUT',
+                    url,
+                    body=body,
+                    headers=headers,
+                    timeout=UPLOAD_TIMEOUT)
+                print("Upload to S3 result: code={}, content={}".format(result.status, result.data))
+        except urllib3.exceptions.HTTPError as e:
+            print("Upload to S3 failed: {}".format(e))
+        finally:
+            # The waiter is released even when the upload failed
+            self.mark_received('response')
 
     def on_ack_received(self, topic, payload, dup, qos, retain, **kwargs):
-        info = json.loads(payload)
+        if not self.is_expected_topic(topic):
+            return
+        info = json_loads(payload)
         print("Received ACK message from topic '{}': {}".format(topic, info))
         if info.get('success') is True:
             print("Transaction successful!")
@@ -205,11 +326,17 @@ class ReceiveCallbacks(object):
         else:
             print("Transaction Status unknown")
             self.success = None
-        self.received_ack.set()
+        self.mark_received('ack')
+
+    def mark_received(self, message):
+        with self.received:
+            self.pending.discard(message)
+            self.received.notify()
 
     def wait_for_responses(self):
-        self.received_response.wait(timeout=self.timeout)
-        self.received_ack.wait(timeout=self.timeout)
+        # A single wait bounded by the timeout, whatever the order the messages arrive in
+        with self.received:
+            self.received.wait_for(lambda: not self.pending, timeout=self.timeout)
 
 
 def test_client(args):
@@ -218,13 +345,27 @@ def test_client(args):
     :param args: parser library arguments
     :return: True for a success, False for a Failure, None for unexpected result
     """
-    receiver = ReceiveCallbacks(args)
-    mqtt_connection = initialise(args, receiver)
-    make_request(args, mqtt_connection)
-    receiver.wait_for_responses()
-
-    print("Disconnecting")
-    mqtt_connection.disconnect()
+    if not os.path.isfile(args.archive_path):
+        print("File {} does not exist".format(args.archive_path))
+        return False
+    # An empty file cannot be memory-mapped
+    if os.path.getsize(args.archive_path) == 0:
+        print("File {} is empty".format(args.archive_path))
+        return False
+    # The mapping is released even if the connection or the request fails
+    with open_archive(args.archive_path) as archive:
+        receiver = ReceiveCallbacks(args, archive)
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            # Hash the archive while the MQTT connection is set up
+            sha256_future = None
+            if args.bad_sha256 is not True:
+                sha256_future = executor.submit(cached_sha256, args.archive_path, archive)
+            mqtt_connection = initialise(args, receiver)
+            make_request(args, mqtt_connection, sha256_future, receiver)
+        receiver.wait_for_responses()
+
+        print("Disconnecting")
+        mqtt_connection.disconnect()
 
     return receiver.success
 
@@ -243,7 +384,8 @@ if __name__ == '__main__':
                                                          "already in your trust store.")
     parser.add_argument('--client_id', required=True, help="Client ID for MQTT connection.")
     parser.add_argument("--archive_path", required=True, help="Path to the archive (zip) file to upload")
-    parser.add_argument("--bad_md5", action=argparse.BooleanOptionalAction, default=False, help="Test for bad MD5 hash")
+    parser.add_argument("--bad_sha256", action=argparse.BooleanOptionalAction, default=False,
+                        help="Test for bad SHA-256 hash")
     parser.add_argument("--bad_payload", action=argparse.BooleanOptionalAction, default=False,
                         help="Test for bad payload")
 